@@ -1,15 +1,27 @@
 import logging
-import random
-import string
+import secrets
 import time
-from datetime import datetime, timedelta
-from typing import Dict, Optional
+from datetime import datetime
+from typing import Dict, Optional, Set
 import asyncio
+import atexit
+import functools
+import html
 import json
 import os
+import re
+import sqlite3
+from collections import OrderedDict
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
+from telegram.constants import ParseMode
+from telegram.request import HTTPXRequest
+from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, Defaults, filters, ContextTypes
 
 # Configure logging
 logging.basicConfig(
@@ -18,11 +30,149 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+DB_FILE = 'bot_data.db'
+# Pre-SQLite data file, imported into DB_FILE on first start
+LEGACY_DATA_FILE = 'bot_data.json'
+# Changes made within this window are coalesced into a single write
+SAVE_DEBOUNCE_SECONDS = 0.5
+# Column order of the users table after the id
+USER_COLUMNS = ('first_name', 'last_name', 'username', 'registered_at', 'otp_count', 'verified_count')
+# Upper bound on outstanding OTPs; the least recently issued are dropped first
+MAX_ACTIVE_OTPS = 10000
+# How often expired OTPs are purged
+OTP_SWEEP_INTERVAL_SECONDS = 60
+# Per-user locks unused for this long are dropped by the sweep
+USER_LOCK_IDLE_SECONDS = 600
+# Connections kept open to the Bot API for outgoing requests
+BOT_API_POOL_SIZE = 64
+# Text messages matching this are treated as OTP codes to verify
+OTP_PATTERN = re.compile(r'\A[0-9]{6}\Z')
+
+WELCOME_TEMPLATE = """
+🔐 <b>Welcome to OTP Bot!</b> 🔐
+
+Hello {name}! I'm your secure OTP (One-Time Password) generator and verification bot.
+
+<b>What I can do:</b>
+• Generate secure OTP codes for various services
+• Verify OTP codes with expiration
+• Track your OTP usage
+• Support multiple authentication scenarios
+
+<b>Commands:</b>
+/start - Show this welcome message
+/generate - Generate a new OTP code
+/verify - Verify an OTP code
+/services - View available services
+/stats - View your OTP statistics
+/help - Get detailed help
+
+<b>Quick Start:</b>
+1. Click "Generate OTP" to create a new code
+2. Use the code within the time limit
+3. Verify it when needed
+
+Let's get started! 🚀
+"""
+
+GENERATE_PROMPT_TEXT = """
+🔑 <b>Select Service for OTP Generation</b>
+
+Choose the service you want to generate an OTP for:
+"""
+
+VERIFY_TEMPLATE = """
+🔍 <b>OTP Verification</b>
+
+{current_otp_info}
+
+<b>To verify an OTP:</b>
+1. Make sure you have an active OTP
+2. Click "Verify Current OTP" or
+3. Type the OTP code directly
+
+<b>Options:</b>
+"""
+
+HELP_TEXT = """
+🆘 <b>OTP Bot Help</b>
+
+<b>Commands:</b>
+• <code>/start</code> - Welcome message and main menu
+• <code>/generate</code> - Generate a new OTP code
+• <code>/verify</code> - Verify an OTP code
+• <code>/services</code> - View available services
+• <code>/stats</code> - View your usage statistics
+• <code>/help</code> - Show this help message
+
+<b>How OTP Generation Works:</b>
+1. Select a service (Email, 2FA, etc.)
+2. Bot generates a 6-digit code
+3. Code expires after set time
+4. Use code for verification
+
+<b>Security Features:</b>
+• ⏰ Time-limited codes (2-10 minutes)
+• 🔒 Single-use verification
+• 🛡️ Secure random generation
+• 📊 Usage tracking
+• 🚫 Automatic expiry
+
+<b>Tips:</b>
+• Generate OTP only when needed
+• Don't share codes with others
+• Use codes within expiry time
+• Keep track of your usage stats
+
+<b>Support:</b>
+If you encounter any issues, please contact the bot administrator.
+
+<b>Version:</b> 1.0.0
+<b>Last Updated:</b> December 2024
+"""
+
+SERVICES_HEADER = """
+🛠️ <b>Available OTP Services</b>
+
+Here are the services you can generate OTPs for:
+"""
+
+SERVICES_FOOTER = """
+<b>How to use:</b>
+1. Select "Generate OTP" from the main menu
+2. Choose the service you need
+3. Use the generated OTP within the time limit
+4. Verify when prompted
+
+<b>Security Features:</b>
+• Time-limited codes
+• Single-use verification
+• Secure generation algorithm
+• Usage tracking
+"""
+
+
+def load_json(raw: bytes):
+    """Parse JSON bytes, using orjson when available"""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def per_user_lock(handler):
+    """Run a handler while holding the calling user's lock"""
+    @functools.wraps(handler)
+    async def wrapper(self, update: Update, context: ContextTypes.DEFAULT_TYPE, *args):
+        async with self._user_lock(update.effective_user.id):
+            return await handler(self, update, context, *args)
+    return wrapper
+
+
 class OTPBot:
     def __init__(self, bot_token: str):
         self.bot_token = bot_token
         self.users: Dict[int, dict] = {}
-        self.otp_codes: Dict[int, dict] = {}
+        self.otp_codes: "OrderedDict[int, dict]" = OrderedDict()
         self.services: Dict[str, dict] = {
             'email_verification': {'name': 'Email Verification', 'expiry': 300},
             'login_2fa': {'name': '2FA Login', 'expiry': 180},
@@ -30,38 +180,295 @@ class OTPBot:
             'transaction_verify': {'name': 'Transaction Verification', 'expiry': 120},
             'account_security': {'name': 'Account Security', 'expiry': 300}
         }
+        # Services are static, so their display values, listing and keyboards are built once
+        for service_info in self.services.values():
+            service_info['expiry_mins'], service_info['expiry_secs'] = divmod(service_info['expiry'], 60)
+        self.services_text = self._build_services_text()
+        self._build_keyboards()
+        # Button callback data mapped to the handler it triggers
+        self._callback_routes = {
+            'main': self.start,
+            'generate': self.show_services_for_generation,
+            'verify': self.verify_otp_command,
+            'verify_current': self.verify_current_otp,
+            'stats': self.show_stats,
+            'services': self.show_services
+        }
+        self._dirty = False
+        self._save_task: Optional[asyncio.Task] = None
+        # Changes queued for the next database write
+        self._pending_users: Dict[int, dict] = {}
+        self._pending_stats: Set[int] = set()
+        self._closing = False
+        self._sweep_task: Optional[asyncio.Task] = None
+        self._user_locks: Dict[int, asyncio.Lock] = {}
+        self._user_lock_used_at: Dict[int, float] = {}
+        self._db = self._connect()
         self.load_data()
+        # Last resort for exits that skip the application's shutdown hook
+        atexit.register(self.save_data)
+
+    def _build_services_text(self) -> str:
+        """Render the /services listing"""
+        parts = [SERVICES_HEADER]
+        for service_id, service_info in self.services.items():
+            parts.append(f"\n<b>{service_info['name']}</b>\n• Expiry: {service_info['expiry_mins']} minutes\n• ID: <code>{service_id}</code>\n")
+        parts.append(SERVICES_FOOTER)
+        return ''.join(parts)
+
+    def _build_keyboards(self):
+        """Create the inline keyboards shared by every request"""
+        self.main_markup = InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔑 Generate OTP", callback_data='generate')],
+            [InlineKeyboardButton("✅ Verify OTP", callback_data='verify')],
+            [InlineKeyboardButton("📊 My Stats", callback_data='stats')],
+            [InlineKeyboardButton("🛠️ Services", callback_data='services')]
+        ])
+        
+        keyboard = []
+        for service_id, service_info in self.services.items():
+            keyboard.append([InlineKeyboardButton(
+                f"🔐 {service_info['name']}", 
+                callback_data=f'gen_{service_id}'
+            )])
+        keyboard.append([InlineKeyboardButton("🔙 Back to Main", callback_data='main')])
+        self.generation_markup = InlineKeyboardMarkup(keyboard)
+        
+        self.generated_markup = InlineKeyboardMarkup([
+            [InlineKeyboardButton("✅ Verify This OTP", callback_data='verify_current')],
+            [InlineKeyboardButton("🔄 Generate New OTP", callback_data='generate')],
+            [InlineKeyboardButton("🔙 Back to Main", callback_data='main')]
+        ])
+        self.verify_markup = InlineKeyboardMarkup([
+            [InlineKeyboardButton("✅ Verify Current OTP", callback_data='verify_current')],
+            [InlineKeyboardButton("🔑 Generate New OTP", callback_data='generate')],
+            [InlineKeyboardButton("🔙 Back to Main", callback_data='main')]
+        ])
+        self.no_otp_markup = InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔑 Generate OTP", callback_data='generate')]
+        ])
+        self.verified_markup = InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔑 Generate New OTP", callback_data='generate')],
+            [InlineKeyboardButton("📊 View Stats", callback_data='stats')],
+            [InlineKeyboardButton("🔙 Back to Main", callback_data='main')]
+        ])
+        self.stats_markup = InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔑 Generate OTP", callback_data='generate')],
+            [InlineKeyboardButton("✅ Verify OTP", callback_data='verify')],
+            [InlineKeyboardButton("🔙 Back to Main", callback_data='main')]
+        ])
+        self.generate_back_markup = InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔑 Generate OTP", callback_data='generate')],
+            [InlineKeyboardButton("🔙 Back to Main", callback_data='main')]
+        ])
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open the user database, creating the schema if needed"""
+        # Writes happen in a worker thread, but only ever one at a time
+        db = sqlite3.connect(DB_FILE, isolation_level=None, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS users ('
+            'id INTEGER PRIMARY KEY, first_name TEXT, last_name TEXT, username TEXT, '
+            'registered_at TEXT, otp_count INTEGER NOT NULL DEFAULT 0, '
+            'verified_count INTEGER NOT NULL DEFAULT 0)'
+        )
+        return db
 
     def load_data(self):
-        """Load user data from file if exists"""
+        """Load user data from the database"""
         try:
-            if os.path.exists('bot_data.json'):
-                with open('bot_data.json', 'r') as f:
-                    data = json.load(f)
-                    self.users = data.get('users', {})
-                    # Convert string keys back to int
-                    self.users = {int(k): v for k, v in self.users.items()}
+            cursor = self._db.cursor()
+            # Ids come back as ints already, so rows map straight onto the mirror
+            cursor.row_factory = lambda _, row: (row[0], dict(zip(USER_COLUMNS, row[1:])))
+            cursor.execute(f"SELECT id, {', '.join(USER_COLUMNS)} FROM users")
+            self.users = dict(cursor)
+            if not self.users:
+                self._import_legacy_data()
         except Exception as e:
             logger.error(f"Error loading data: {e}")
 
+    def _import_legacy_data(self):
+        """Move users from the old JSON data file into the database"""
+        if not os.path.exists(LEGACY_DATA_FILE):
+            return
+        with open(LEGACY_DATA_FILE, 'rb') as f:
+            data = load_json(f.read())
+        # Convert string keys back to int
+        self.users = {int(k): v for k, v in data.get('users', {}).items()}
+        self._pending_users.update(self.users)
+        self.save_data()
+        logger.info(f"Imported {len(self.users)} users from {LEGACY_DATA_FILE}")
+
     def save_data(self):
-        """Save user data to file"""
+        """Write pending user changes to the database"""
+        self._dirty = False
+        if not self._has_pending():
+            return
+        new_users, stats = self._take_pending()
         try:
-            data = {
-                'users': self.users,
-                'timestamp': datetime.now().isoformat()
-            }
-            with open('bot_data.json', 'w') as f:
-                json.dump(data, f, indent=2)
+            self._write_rows(new_users, stats)
         except Exception as e:
             logger.error(f"Error saving data: {e}")
+            self._requeue(new_users, stats)
+
+    def _has_pending(self) -> bool:
+        """Check whether any changes are waiting to be written"""
+        return bool(self._pending_users or self._pending_stats)
+
+    def _take_pending(self):
+        """Turn queued changes into rows and clear the queue"""
+        new_users = [
+            (user_id, *(user_data.get(column) for column in USER_COLUMNS))
+            for user_id, user_data in self._pending_users.items()
+        ]
+        stats = [
+            (self.users[user_id]['otp_count'], self.users[user_id]['verified_count'], user_id)
+            for user_id in self._pending_stats
+            # New users are inserted with their current counters anyway
+            if user_id not in self._pending_users
+        ]
+        self._pending_users.clear()
+        self._pending_stats.clear()
+        return new_users, stats
+
+    def _requeue(self, new_users: list, stats: list):
+        """Put rows from a failed write back in the queue for the next one"""
+        for row in new_users:
+            # A newer queued entry for the same user already has current data
+            self._pending_users.setdefault(row[0], self.users[row[0]])
+        self._pending_stats.update(row[2] for row in stats)
+        self._dirty = True
+
+    def _write_rows(self, new_users: list, stats: list):
+        """Apply new users and counter updates in a single transaction"""
+        self._db.execute('BEGIN')
+        try:
+            if new_users:
+                self._db.executemany('INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?, ?, ?)', new_users)
+            if stats:
+                cursor = self._db.executemany('UPDATE users SET otp_count = ?, verified_count = ? WHERE id = ?', stats)
+                if cursor.rowcount != len(stats):
+                    logger.warning(f"{len(stats) - cursor.rowcount} counter updates matched no user row")
+            self._db.execute('COMMIT')
+        except Exception:
+            self._db.execute('ROLLBACK')
+            raise
+
+    def _record_user(self, user_id: int):
+        """Queue a newly registered user for insertion"""
+        self._pending_users[user_id] = self.users[user_id]
+        self._mark_dirty()
+
+    def _record_stats(self, user_id: int):
+        """Queue the current counters of a user for writing"""
+        self._pending_stats.add(user_id)
+        self._mark_dirty()
+
+    def _mark_dirty(self):
+        """Schedule a debounced database write"""
+        self._dirty = True
+        if self._save_task is None or self._save_task.done():
+            self._save_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        """Write queued changes off the event loop once they settle"""
+        while self._dirty:
+            await asyncio.sleep(SAVE_DEBOUNCE_SECONDS)
+            self._dirty = False
+            if not self._has_pending():
+                continue
+            # Rows are built on the loop thread so handlers can't change them mid-write
+            new_users, stats = self._take_pending()
+            try:
+                await asyncio.to_thread(self._write_rows, new_users, stats)
+            except Exception as e:
+                logger.error(f"Error saving data: {e}")
+                # Retry on the next round, unless shutdown's final save takes over
+                self._requeue(new_users, stats)
+                if self._closing:
+                    break
+
+    def _store_otp(self, user_id: int, otp_data: dict):
+        """Store an OTP, evicting the oldest ones when over capacity"""
+        self.otp_codes[user_id] = otp_data
+        self.otp_codes.move_to_end(user_id)
+        while len(self.otp_codes) > MAX_ACTIVE_OTPS:
+            self.otp_codes.popitem(last=False)
+
+    def _purge_expired_otps(self):
+        """Drop every OTP whose expiry has passed"""
+        now = time.time()
+        expired = [uid for uid, otp_data in self.otp_codes.items() if otp_data['expires_at'] < now]
+        for uid in expired:
+            del self.otp_codes[uid]
+
+    def _user_lock(self, user_id: int) -> asyncio.Lock:
+        """Get the lock serializing state changes for a user"""
+        self._user_lock_used_at[user_id] = time.monotonic()
+        lock = self._user_locks.get(user_id)
+        if lock is None:
+            lock = self._user_locks[user_id] = asyncio.Lock()
+        return lock
+
+    def _purge_idle_locks(self):
+        """Drop user locks that are free and haven't been used in a while"""
+        cutoff = time.monotonic() - USER_LOCK_IDLE_SECONDS
+        idle = [
+            uid for uid, lock in self._user_locks.items()
+            if not lock.locked() and self._user_lock_used_at[uid] < cutoff
+        ]
+        for uid in idle:
+            del self._user_locks[uid]
+            del self._user_lock_used_at[uid]
+
+    async def _sweep_periodically(self):
+        """Purge expired OTPs and idle locks every OTP_SWEEP_INTERVAL_SECONDS"""
+        while True:
+            await asyncio.sleep(OTP_SWEEP_INTERVAL_SECONDS)
+            self._purge_expired_otps()
+            self._purge_idle_locks()
+
+    async def _on_startup(self, application: Application) -> None:
+        """Start background maintenance once the event loop is running"""
+        self._sweep_task = asyncio.create_task(self._sweep_periodically())
+
+    async def _on_shutdown(self, application: Application) -> None:
+        """Flush pending changes before the bot exits"""
+        self._closing = True
+        if self._sweep_task is not None:
+            self._sweep_task.cancel()
+        if self._save_task is not None:
+            await self._save_task
+        self.save_data()
+        # The connection is about to close, so the exit hook could only fail
+        atexit.unregister(self.save_data)
+        if self._has_pending():
+            logger.error("Exiting with user changes that could not be saved")
+        self._db.close()
+
+    def _get_or_register(self, user) -> dict:
+        """Return a user's data, registering them on first contact"""
+        user_data = self.users.get(user.id)
+        if user_data is None:
+            user_data = self.users[user.id] = {
+                'first_name': user.first_name,
+                'last_name': user.last_name,
+                'username': user.username,
+                'registered_at': datetime.now().isoformat(),
+                'otp_count': 0,
+                'verified_count': 0
+            }
+            self._record_user(user.id)
+        return user_data
 
     def generate_otp(self, length: int = 6) -> str:
-        """Generate a random OTP code"""
-        return ''.join(random.choices(string.digits, k=length))
+        """Generate a cryptographically secure OTP code"""
+        return f"{secrets.randbelow(10 ** length):0{length}d}"
 
-    def is_otp_valid(self, user_id: int, otp: str) -> bool:
-        """Check if OTP is valid and not expired"""
+    def is_otp_valid(self, user_id: int, otp: str, now: Optional[float] = None) -> bool:
+        """Check if OTP is valid and not expired as of now (epoch seconds)"""
         if user_id not in self.otp_codes:
             return False
         
@@ -70,7 +477,9 @@ class OTPBot:
             return False
         
         # Check if OTP is expired
-        if datetime.now() > otp_data['expires_at']:
+        if now is None:
+            now = time.time()
+        if now > otp_data['expires_at']:
             del self.otp_codes[user_id]
             return False
         
@@ -79,60 +488,19 @@ class OTPBot:
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle /start command"""
         user = update.effective_user
-        user_id = user.id
         
         # Register user if not exists
-        if user_id not in self.users:
-            self.users[user_id] = {
-                'first_name': user.first_name,
-                'last_name': user.last_name,
-                'username': user.username,
-                'registered_at': datetime.now().isoformat(),
-                'otp_count': 0,
-                'verified_count': 0
-            }
-            self.save_data()
+        self._get_or_register(user)
         
-        welcome_message = f"""
-🔐 **Welcome to OTP Bot!** 🔐
-
-Hello {user.first_name}! I'm your secure OTP (One-Time Password) generator and verification bot.
-
-**What I can do:**
-• Generate secure OTP codes for various services
-• Verify OTP codes with expiration
-• Track your OTP usage
-• Support multiple authentication scenarios
-
-**Commands:**
-/start - Show this welcome message
-/generate - Generate a new OTP code
-/verify - Verify an OTP code
-/services - View available services
-/stats - View your OTP statistics
-/help - Get detailed help
-
-**Quick Start:**
-1. Click "Generate OTP" to create a new code
-2. Use the code within the time limit
-3. Verify it when needed
-
-Let's get started! 🚀
-        """
+        welcome_message = WELCOME_TEMPLATE.format(name=html.escape(user.first_name))
         
-        keyboard = [
-            [InlineKeyboardButton("🔑 Generate OTP", callback_data='generate')],
-            [InlineKeyboardButton("✅ Verify OTP", callback_data='verify')],
-            [InlineKeyboardButton("📊 My Stats", callback_data='stats')],
-            [InlineKeyboardButton("🛠️ Services", callback_data='services')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = self.main_markup
         
         # Handle both message and callback query
         if update.callback_query:
-            await update.callback_query.edit_message_text(welcome_message, reply_markup=reply_markup, parse_mode='Markdown')
+            await update.callback_query.edit_message_text(welcome_message, reply_markup=reply_markup)
         else:
-            await update.message.reply_text(welcome_message, reply_markup=reply_markup, parse_mode='Markdown')
+            await update.message.reply_text(welcome_message, reply_markup=reply_markup)
 
     async def generate_otp_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle /generate command"""
@@ -140,79 +508,59 @@ Let's get started! 🚀
 
     async def show_services_for_generation(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Show services selection for OTP generation"""
-        keyboard = []
-        for service_id, service_info in self.services.items():
-            keyboard.append([InlineKeyboardButton(
-                f"🔐 {service_info['name']}", 
-                callback_data=f'gen_{service_id}'
-            )])
+        reply_markup = self.generation_markup
         
-        keyboard.append([InlineKeyboardButton("🔙 Back to Main", callback_data='main')])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        message = """
-🔑 **Select Service for OTP Generation**
-
-Choose the service you want to generate an OTP for:
-        """
+        message = GENERATE_PROMPT_TEXT
         
         if update.callback_query:
-            await update.callback_query.edit_message_text(message, reply_markup=reply_markup, parse_mode='Markdown')
+            await update.callback_query.edit_message_text(message, reply_markup=reply_markup)
         else:
-            await update.message.reply_text(message, reply_markup=reply_markup, parse_mode='Markdown')
+            await update.message.reply_text(message, reply_markup=reply_markup)
 
+    @per_user_lock
     async def generate_otp_for_service(self, update: Update, context: ContextTypes.DEFAULT_TYPE, service_id: str) -> None:
         """Generate OTP for specific service"""
         user_id = update.effective_user.id
         service_info = self.services[service_id]
         
         # Generate OTP
+        now = datetime.now()
         otp_code = self.generate_otp()
-        expiry_seconds = service_info['expiry']
-        expires_at = datetime.now() + timedelta(seconds=expiry_seconds)
+        expires_at = now.timestamp() + service_info['expiry']
         
         # Store OTP
-        self.otp_codes[user_id] = {
+        self._store_otp(user_id, {
             'code': otp_code,
             'service': service_id,
             'service_name': service_info['name'],
-            'created_at': datetime.now(),
+            'created_at': now,
             'expires_at': expires_at,
             'used': False
-        }
+        })
         
         # Update user stats
-        self.users[user_id]['otp_count'] += 1
-        self.save_data()
-        
-        # Format expiry time
-        expiry_mins = expiry_seconds // 60
-        expiry_secs = expiry_seconds % 60
+        self._get_or_register(update.effective_user)['otp_count'] += 1
+        self._record_stats(user_id)
         
         message = f"""
-🔑 **OTP Generated Successfully!**
+🔑 <b>OTP Generated Successfully!</b>
 
-**Service:** {service_info['name']}
-**OTP Code:** `{otp_code}`
-**Expires in:** {expiry_mins}:{expiry_secs:02d} minutes
-**Generated at:** {datetime.now().strftime('%H:%M:%S')}
+<b>Service:</b> {service_info['name']}
+<b>OTP Code:</b> <code>{otp_code}</code>
+<b>Expires in:</b> {service_info['expiry_mins']}:{service_info['expiry_secs']:02d} minutes
+<b>Generated at:</b> {now.strftime('%H:%M:%S')}
 
-⚠️ **Important:**
-• This code is valid for {expiry_mins} minutes only
+⚠️ <b>Important:</b>
+• This code is valid for {service_info['expiry_mins']} minutes only
 • Don't share this code with anyone
 • Use it only for the intended service
 
-*Tap the code to copy it*
+<i>Tap the code to copy it</i>
         """
         
-        keyboard = [
-            [InlineKeyboardButton("✅ Verify This OTP", callback_data='verify_current')],
-            [InlineKeyboardButton("🔄 Generate New OTP", callback_data='generate')],
-            [InlineKeyboardButton("🔙 Back to Main", callback_data='main')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = self.generated_markup
         
-        await update.callback_query.edit_message_text(message, reply_markup=reply_markup, parse_mode='Markdown')
+        await update.callback_query.edit_message_text(message, reply_markup=reply_markup)
 
     async def verify_otp_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle /verify command"""
@@ -220,297 +568,205 @@ Choose the service you want to generate an OTP for:
         
         if user_id in self.otp_codes:
             otp_data = self.otp_codes[user_id]
-            time_left = (otp_data['expires_at'] - datetime.now()).total_seconds()
+            time_left = otp_data['expires_at'] - time.time()
             
             if time_left > 0:
                 mins, secs = divmod(int(time_left), 60)
                 current_otp_info = f"""
-**Current OTP:** `{otp_data['code']}`
-**Service:** {otp_data['service_name']}
-**Time Left:** {mins}:{secs:02d}
+<b>Current OTP:</b> <code>{otp_data['code']}</code>
+<b>Service:</b> {otp_data['service_name']}
+<b>Time Left:</b> {mins}:{secs:02d}
                 """
             else:
-                current_otp_info = "❌ **No active OTP** (expired or not generated)"
+                current_otp_info = "❌ <b>No active OTP</b> (expired or not generated)"
         else:
-            current_otp_info = "❌ **No active OTP** (not generated yet)"
+            current_otp_info = "❌ <b>No active OTP</b> (not generated yet)"
         
-        message = f"""
-🔍 **OTP Verification**
-
-{current_otp_info}
-
-**To verify an OTP:**
-1. Make sure you have an active OTP
-2. Click "Verify Current OTP" or
-3. Type the OTP code directly
-
-**Options:**
-        """
+        message = VERIFY_TEMPLATE.format(current_otp_info=current_otp_info)
         
-        keyboard = [
-            [InlineKeyboardButton("✅ Verify Current OTP", callback_data='verify_current')],
-            [InlineKeyboardButton("🔑 Generate New OTP", callback_data='generate')],
-            [InlineKeyboardButton("🔙 Back to Main", callback_data='main')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = self.verify_markup
         
         if update.callback_query:
-            await update.callback_query.edit_message_text(message, reply_markup=reply_markup, parse_mode='Markdown')
+            await update.callback_query.edit_message_text(message, reply_markup=reply_markup)
         else:
-            await update.message.reply_text(message, reply_markup=reply_markup, parse_mode='Markdown')
+            await update.message.reply_text(message, reply_markup=reply_markup)
 
+    @per_user_lock
     async def verify_current_otp(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Verify the current OTP"""
         user_id = update.effective_user.id
         
         if user_id not in self.otp_codes:
-            message = "❌ **No OTP to verify!**\n\nPlease generate an OTP first."
-            keyboard = [[InlineKeyboardButton("🔑 Generate OTP", callback_data='generate')]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await update.callback_query.edit_message_text(message, reply_markup=reply_markup, parse_mode='Markdown')
+            message = "❌ <b>No OTP to verify!</b>\n\nPlease generate an OTP first."
+            reply_markup = self.no_otp_markup
+            await update.callback_query.edit_message_text(message, reply_markup=reply_markup)
             return
         
         otp_data = self.otp_codes[user_id]
+        now = datetime.now()
         
-        if self.is_otp_valid(user_id, otp_data['code']):
+        if self.is_otp_valid(user_id, otp_data['code'], now.timestamp()):
             # Mark as used
             self.otp_codes[user_id]['used'] = True
             self.users[user_id]['verified_count'] += 1
-            self.save_data()
+            self._record_stats(user_id)
             
             # Remove OTP after verification
             del self.otp_codes[user_id]
             
             message = f"""
-✅ **OTP Verified Successfully!**
+✅ <b>OTP Verified Successfully!</b>
 
-**Service:** {otp_data['service_name']}
-**OTP Code:** `{otp_data['code']}`
-**Verified at:** {datetime.now().strftime('%H:%M:%S')}
+<b>Service:</b> {otp_data['service_name']}
+<b>OTP Code:</b> <code>{otp_data['code']}</code>
+<b>Verified at:</b> {now.strftime('%H:%M:%S')}
 
-🎉 **Verification Complete!**
+🎉 <b>Verification Complete!</b>
 Your OTP has been successfully verified and is now used.
             """
         else:
             message = f"""
-❌ **OTP Verification Failed!**
+❌ <b>OTP Verification Failed!</b>
 
-**Reason:** OTP has expired
-**Service:** {otp_data['service_name']}
-**OTP Code:** `{otp_data['code']}`
+<b>Reason:</b> OTP has expired
+<b>Service:</b> {otp_data['service_name']}
+<b>OTP Code:</b> <code>{otp_data['code']}</code>
 
 Please generate a new OTP code.
             """
         
-        keyboard = [
-            [InlineKeyboardButton("🔑 Generate New OTP", callback_data='generate')],
-            [InlineKeyboardButton("📊 View Stats", callback_data='stats')],
-            [InlineKeyboardButton("🔙 Back to Main", callback_data='main')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = self.verified_markup
         
-        await update.callback_query.edit_message_text(message, reply_markup=reply_markup, parse_mode='Markdown')
+        await update.callback_query.edit_message_text(message, reply_markup=reply_markup)
 
     async def show_stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Show user statistics"""
         user_id = update.effective_user.id
-        user_data = self.users[user_id]
+        user_data = self._get_or_register(update.effective_user)
         
         # Current OTP info
         current_otp_info = ""
         if user_id in self.otp_codes:
             otp_data = self.otp_codes[user_id]
-            time_left = (otp_data['expires_at'] - datetime.now()).total_seconds()
+            time_left = otp_data['expires_at'] - time.time()
             
             if time_left > 0:
                 mins, secs = divmod(int(time_left), 60)
                 current_otp_info = f"""
-**🔄 Current OTP Status:**
-• Code: `{otp_data['code']}`
+<b>🔄 Current OTP Status:</b>
+• Code: <code>{otp_data['code']}</code>
 • Service: {otp_data['service_name']}
 • Time Left: {mins}:{secs:02d}
 • Status: Active ✅
                 """
             else:
                 current_otp_info = """
-**🔄 Current OTP Status:**
+<b>🔄 Current OTP Status:</b>
 • Status: Expired ❌
                 """
         else:
             current_otp_info = """
-**🔄 Current OTP Status:**
+<b>🔄 Current OTP Status:</b>
 • Status: No active OTP
             """
         
         registered_date = datetime.fromisoformat(user_data['registered_at']).strftime('%B %d, %Y')
         
         message = f"""
-📊 **Your OTP Statistics**
+📊 <b>Your OTP Statistics</b>
 
-**👤 User Info:**
-• Name: {user_data['first_name']} {user_data.get('last_name', '') or ''}
-• Username: @{user_data.get('username', 'N/A')}
+<b>👤 User Info:</b>
+• Name: {html.escape(user_data['first_name'])} {html.escape(user_data.get('last_name', '') or '')}
+• Username: @{html.escape(user_data.get('username') or 'N/A')}
 • Registered: {registered_date}
 
-**📈 Usage Stats:**
+<b>📈 Usage Stats:</b>
 • Total OTPs Generated: {user_data['otp_count']}
 • Total OTPs Verified: {user_data['verified_count']}
 • Success Rate: {(user_data['verified_count'] / max(user_data['otp_count'], 1) * 100):.1f}%
 
 {current_otp_info}
 
-**🛠️ Available Services:** {len(self.services)}
+<b>🛠️ Available Services:</b> {len(self.services)}
         """
         
-        keyboard = [
-            [InlineKeyboardButton("🔑 Generate OTP", callback_data='generate')],
-            [InlineKeyboardButton("✅ Verify OTP", callback_data='verify')],
-            [InlineKeyboardButton("🔙 Back to Main", callback_data='main')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = self.stats_markup
         
         if update.callback_query:
-            await update.callback_query.edit_message_text(message, reply_markup=reply_markup, parse_mode='Markdown')
+            await update.callback_query.edit_message_text(message, reply_markup=reply_markup)
         else:
-            await update.message.reply_text(message, reply_markup=reply_markup, parse_mode='Markdown')
+            await update.message.reply_text(message, reply_markup=reply_markup)
 
     async def show_services(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Show available services"""
-        message = """
-🛠️ **Available OTP Services**
-
-Here are the services you can generate OTPs for:
-        """
-        
-        for service_id, service_info in self.services.items():
-            expiry_mins = service_info['expiry'] // 60
-            message += f"\n**{service_info['name']}**\n• Expiry: {expiry_mins} minutes\n• ID: `{service_id}`\n"
-        
-        message += """
-**How to use:**
-1. Select "Generate OTP" from the main menu
-2. Choose the service you need
-3. Use the generated OTP within the time limit
-4. Verify when prompted
-
-**Security Features:**
-• Time-limited codes
-• Single-use verification
-• Secure generation algorithm
-• Usage tracking
-        """
+        message = self.services_text
         
-        keyboard = [
-            [InlineKeyboardButton("🔑 Generate OTP", callback_data='generate')],
-            [InlineKeyboardButton("🔙 Back to Main", callback_data='main')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = self.generate_back_markup
         
         if update.callback_query:
-            await update.callback_query.edit_message_text(message, reply_markup=reply_markup, parse_mode='Markdown')
+            await update.callback_query.edit_message_text(message, reply_markup=reply_markup)
         else:
-            await update.message.reply_text(message, reply_markup=reply_markup, parse_mode='Markdown')
+            await update.message.reply_text(message, reply_markup=reply_markup)
 
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle /help command"""
-        message = """
-🆘 **OTP Bot Help**
-
-**Commands:**
-• `/start` - Welcome message and main menu
-• `/generate` - Generate a new OTP code
-• `/verify` - Verify an OTP code
-• `/services` - View available services
-• `/stats` - View your usage statistics
-• `/help` - Show this help message
-
-**How OTP Generation Works:**
-1. Select a service (Email, 2FA, etc.)
-2. Bot generates a 6-digit code
-3. Code expires after set time
-4. Use code for verification
-
-**Security Features:**
-• ⏰ Time-limited codes (2-10 minutes)
-• 🔒 Single-use verification
-• 🛡️ Secure random generation
-• 📊 Usage tracking
-• 🚫 Automatic expiry
-
-**Tips:**
-• Generate OTP only when needed
-• Don't share codes with others
-• Use codes within expiry time
-• Keep track of your usage stats
-
-**Support:**
-If you encounter any issues, please contact the bot administrator.
-
-**Version:** 1.0.0
-**Last Updated:** December 2024
-        """
+        message = HELP_TEXT
         
-        keyboard = [
-            [InlineKeyboardButton("🔑 Generate OTP", callback_data='generate')],
-            [InlineKeyboardButton("🔙 Back to Main", callback_data='main')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = self.generate_back_markup
         
-        await update.message.reply_text(message, reply_markup=reply_markup, parse_mode='Markdown')
+        await update.message.reply_text(message, reply_markup=reply_markup)
 
+    @per_user_lock
     async def handle_text_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Handle text messages (potential OTP codes)"""
         user_id = update.effective_user.id
         message_text = update.message.text.strip()
         
         # Check if it's a 6-digit number (potential OTP)
-        if message_text.isdigit() and len(message_text) == 6:
+        if len(message_text) == 6 and OTP_PATTERN.match(message_text):
             if user_id in self.otp_codes:
-                if self.is_otp_valid(user_id, message_text):
+                now = datetime.now()
+                if self.is_otp_valid(user_id, message_text, now.timestamp()):
                     # Mark as used
                     otp_data = self.otp_codes[user_id]
                     self.otp_codes[user_id]['used'] = True
                     self.users[user_id]['verified_count'] += 1
-                    self.save_data()
+                    self._record_stats(user_id)
                     
                     # Remove OTP after verification
                     del self.otp_codes[user_id]
                     
                     await update.message.reply_text(
-                        f"✅ **OTP Verified Successfully!**\n\n"
-                        f"**Service:** {otp_data['service_name']}\n"
-                        f"**Code:** `{message_text}`\n"
-                        f"**Verified at:** {datetime.now().strftime('%H:%M:%S')}\n\n"
-                        f"🎉 Your OTP has been successfully verified!",
-                        parse_mode='Markdown'
+                        f"✅ <b>OTP Verified Successfully!</b>\n\n"
+                        f"<b>Service:</b> {otp_data['service_name']}\n"
+                        f"<b>Code:</b> <code>{message_text}</code>\n"
+                        f"<b>Verified at:</b> {now.strftime('%H:%M:%S')}\n\n"
+                        f"🎉 Your OTP has been successfully verified!"
                     )
                 else:
                     await update.message.reply_text(
-                        "❌ **Invalid or Expired OTP**\n\n"
+                        "❌ <b>Invalid or Expired OTP</b>\n\n"
                         "The OTP you entered is either:\n"
                         "• Incorrect\n"
                         "• Expired\n"
                         "• Already used\n\n"
-                        "Please generate a new OTP code.",
-                        parse_mode='Markdown'
+                        "Please generate a new OTP code."
                     )
             else:
                 await update.message.reply_text(
-                    "❌ **No Active OTP**\n\n"
+                    "❌ <b>No Active OTP</b>\n\n"
                     "You don't have any active OTP to verify.\n"
-                    "Please generate an OTP first using /generate",
-                    parse_mode='Markdown'
+                    "Please generate an OTP first using /generate"
                 )
         else:
             # Not an OTP, show help
             await update.message.reply_text(
-                "🤔 **I didn't understand that**\n\n"
+                "🤔 <b>I didn't understand that</b>\n\n"
                 "I can help you with:\n"
                 "• Generate OTP codes\n"
                 "• Verify OTP codes\n"
                 "• View statistics\n\n"
-                "Use /help for more information or /start for the main menu.",
-                parse_mode='Markdown'
+                "Use /help for more information or /start for the main menu."
             )
 
     async def button_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -518,18 +774,9 @@ If you encounter any issues, please contact the bot administrator.
         query = update.callback_query
         await query.answer()
         
-        if query.data == 'main':
-            await self.start(update, context)
-        elif query.data == 'generate':
-            await self.show_services_for_generation(update, context)
-        elif query.data == 'verify':
-            await self.verify_otp_command(update, context)
-        elif query.data == 'verify_current':
-            await self.verify_current_otp(update, context)
-        elif query.data == 'stats':
-            await self.show_stats(update, context)
-        elif query.data == 'services':
-            await self.show_services(update, context)
+        handler = self._callback_routes.get(query.data)
+        if handler is not None:
+            await handler(update, context)
         elif query.data.startswith('gen_'):
             service_id = query.data[4:]  # Remove 'gen_' prefix
             await self.generate_otp_for_service(update, context, service_id)
@@ -544,8 +791,32 @@ If you encounter any issues, please contact the bot administrator.
 
     def run(self):
         """Run the bot"""
+        # Use the faster libuv-based event loop when it's installed
+        try:
+            import uvloop
+            uvloop.install()
+        except ImportError:
+            pass
+        
         # Create application
-        application = Application.builder().token(self.bot_token).build()
+        application = (
+            Application.builder()
+            .token(self.bot_token)
+            .request(HTTPXRequest(
+                connection_pool_size=BOT_API_POOL_SIZE,
+                read_timeout=30,
+                write_timeout=30,
+                pool_timeout=5
+            ))
+            # getUpdates is a single long-poll and never needs more than one connection
+            .get_updates_request(HTTPXRequest(connection_pool_size=1, read_timeout=30))
+            # Handle up to one update per pooled connection in parallel; per-user locks guard state changes
+            .concurrent_updates(BOT_API_POOL_SIZE)
+            .defaults(Defaults(parse_mode=ParseMode.HTML))
+            .post_init(self._on_startup)
+            .post_shutdown(self._on_shutdown)
+            .build()
+        )
         
         # Add handlers
         application.add_handler(CommandHandler("start", self.start))
@@ -560,7 +831,20 @@ If you encounter any issues, please contact the bot administrator.
         # Run the bot
         print("🤖 OTP Bot is starting...")
         print("📱 Bot is ready to generate and verify OTP codes!")
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        # Only messages and button presses are handled, skip everything else
+        allowed_updates = [Update.MESSAGE, Update.CALLBACK_QUERY]
+        webhook_url = os.environ.get('WEBHOOK_URL')
+        if webhook_url:
+            # Let Telegram push updates to us instead of long-polling
+            application.run_webhook(
+                listen="0.0.0.0",
+                port=int(os.environ.get('PORT', 8443)),
+                url_path=self.bot_token,
+                webhook_url=f"{webhook_url.rstrip('/')}/{self.bot_token}",
+                allowed_updates=allowed_updates
+            )
+        else:
+            application.run_polling(allowed_updates=allowed_updates)
 
 def main():
     """Main function"""